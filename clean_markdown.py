@@ -1,104 +1,208 @@
 import os
 import argparse
+import asyncio
+import contextlib
 import logging
-import boto3
-import json
+import aioboto3
+import aiofiles
+import aiofiles.os
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+from markdown_it import MarkdownIt
+import hashlib
+import orjson
+import random
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from typing import Optional
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-import threading
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Add thread-local storage for boto3 clients
-thread_local = threading.local()
+# A single client is shared by every in-flight request, so the default pool
+# of 10 connections is far too small. Each file sends at most
+# MAX_REQUESTS_PER_FILE requests at once, so the pool is sized to
+# workers * MAX_REQUESTS_PER_FILE, and never below MIN_POOL_CONNECTIONS.
+MIN_POOL_CONNECTIONS = 50
+MAX_REQUESTS_PER_FILE = 8
 
-# Modify get_bedrock_client to use thread-local storage
-def get_bedrock_client():
-    """Initialize and return the Bedrock client using thread-local storage"""
-    if not hasattr(thread_local, "client"):
-        thread_local.client = boto3.client(
-            service_name='bedrock-runtime',
-            region_name='us-east-1'  # Change this to your preferred region
+def get_bedrock_client(session: aioboto3.Session, max_pool_connections: int = MIN_POOL_CONNECTIONS):
+    """Create the async Bedrock client (use as an async context manager)"""
+    return session.client(
+        service_name='bedrock-runtime',
+        region_name='us-east-1',  # Change this to your preferred region
+        config=AioConfig(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            retries={'max_attempts': 10, 'mode': 'adaptive'}
         )
-    return thread_local.client
+    )
 
-def split_content(content: str, max_chunk_size: int = 6000) -> list:
-    """Split content into chunks that respect markdown structure"""
-    # First try to split on double newlines
-    sections = content.split('\n\n')
-    chunks = []
-    current_chunk = []
-    current_size = 0
+# Content-defined chunking: a segment closes its chunk when its hash is 0 mod
+# CDC_MODULUS, so boundaries depend only on local content and an edit only
+# changes the chunk it lands in. With typical ~500 character paragraphs this
+# averages ~4KB per chunk.
+CDC_MODULUS = 8
+
+# Parse once with tables enabled so they are kept as a single block
+markdown_parser = MarkdownIt('commonmark').enable('table')
+
+# YAML (---) or TOML (+++) frontmatter at the very start of the file
+FRONTMATTER_RE = re.compile(r'\A(---|\+\+\+)[ \t]*\n.*?\n\1[ \t]*(?:\n|\Z)', re.DOTALL)
+
+def _is_chunk_boundary(section: str) -> bool:
+    """Return True if the section should end a chunk"""
+    return hashlib.blake2b(section.encode(), digest_size=8).digest()[0] % CDC_MODULUS == 0
+
+def _markdown_blocks(content: str) -> list:
+    """
+    Tokenize markdown once and return its top-level blocks as (heading level, text, size)
+    tuples, where the heading level is 0 for anything that is not a heading.
+    Code fences, lists and tables come back as single blocks.
+    """
+    blocks = []
+    frontmatter = FRONTMATTER_RE.match(content)
+    if frontmatter:
+        text = frontmatter.group(0).rstrip('\n')
+        blocks.append((0, text, len(text)))
+        content = content[frontmatter.end():]
     
-    logger.info(f"Original content size: {len(content)} characters")
-    logger.info(f"Split into {len(sections)} initial sections")
+    lines = content.split('\n')
+    # Only top-level opening tokens carry a source line map
+    starts = [
+        (token.map[0], int(token.tag[1]) if token.type == 'heading_open' else 0)
+        for token in markdown_parser.parse(content)
+        if token.level == 0 and token.map
+    ]
+    if starts:
+        # Lines before the first token (e.g. link reference definitions, which
+        # produce no tokens) belong to the first block
+        starts[0] = (0, starts[0][1])
+    else:
+        starts = [(0, 0)]
+    for i, (start, level) in enumerate(starts):
+        # Each block runs up to the next one so no source text is dropped
+        end = starts[i + 1][0] if i + 1 < len(starts) else len(lines)
+        text = '\n'.join(lines[start:end]).strip('\n')
+        if text:
+            blocks.append((level, text, len(text)))
     
-    for section in sections:
-        # If a single section is too large, split it further on single newlines
-        if len(section) > max_chunk_size:
-            logger.info(f"Found large section of size {len(section)}, splitting further")
-            subsections = section.split('\n')
-            
-            for subsection in subsections:
-                # If still too large, split on periods, preserving them
-                if len(subsection) > max_chunk_size:
-                    logger.info(f"Found large subsection of size {len(subsection)}, splitting on sentences")
-                    sentences = [s + '.' for s in subsection.split('.') if s]
-                    for sentence in sentences:
-                        if current_size + len(sentence) > max_chunk_size and current_chunk:
-                            chunk_content = '\n'.join(current_chunk)
-                            logger.info(f"Creating chunk {len(chunks)}: {len(chunk_content)} characters")
-                            chunks.append(chunk_content)
-                            current_chunk = []
-                            current_size = 0
-                        current_chunk.append(sentence)
-                        current_size += len(sentence)
-                else:
-                    if current_size + len(subsection) > max_chunk_size and current_chunk:
-                        chunk_content = '\n'.join(current_chunk)
-                        logger.info(f"Creating chunk {len(chunks)}: {len(chunk_content)} characters")
-                        chunks.append(chunk_content)
-                        current_chunk = []
-                        current_size = 0
-                    current_chunk.append(subsection)
-                    current_size += len(subsection)
+    # Blank content still yields one (empty) block so it round-trips as a chunk
+    if not blocks:
+        blocks.append((0, content, len(content)))
+    return blocks
+
+def _split_oversize(text: str, max_chunk_size: int) -> list:
+    """Split a single block that is too large for one chunk on lines, then sentences"""
+    pieces = []
+    for line in text.split('\n'):
+        if len(line) > max_chunk_size:
+            # Split on periods, preserving them, then hard-cut anything still too long
+            for sentence in (s + '.' for s in line.split('.') if s):
+                pieces.extend(sentence[i:i + max_chunk_size] for i in range(0, len(sentence), max_chunk_size))
         else:
-            if current_size + len(section) > max_chunk_size and current_chunk:
-                chunk_content = '\n\n'.join(current_chunk)
-                logger.info(f"Creating chunk {len(chunks)}: {len(chunk_content)} characters")
-                chunks.append(chunk_content)
-                current_chunk = []
-                current_size = 0
-            current_chunk.append(section)
-            current_size += len(section)
+            pieces.append(line)
+    
+    sizes = [len(piece) for piece in pieces]
+    segments = []
+    start = 0
+    current_size = 0
+    for i, size in enumerate(sizes):
+        if current_size + size > max_chunk_size and i > start:
+            segments.append('\n'.join(pieces[start:i]))
+            start = i
+            current_size = 0
+        current_size += size + 1
+    if start < len(pieces):
+        segments.append('\n'.join(pieces[start:]))
+    return segments
+
+def _split_blocks(blocks: list, max_chunk_size: int) -> list:
+    """
+    Recursively split blocks at the highest heading level present until every
+    segment fits in max_chunk_size (H1 -> H2 -> ... -> paragraph -> sentence)
+    """
+    size = sum(block[2] for block in blocks) + 2 * (len(blocks) - 1)
+    if size <= max_chunk_size:
+        return ['\n\n'.join(block[1] for block in blocks)]
     
-    if current_chunk:
-        chunk_content = '\n\n'.join(current_chunk)
-        logger.info(f"Creating final chunk {len(chunks)}: {len(chunk_content)} characters")
-        chunks.append(chunk_content)
+    if len(blocks) == 1:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Found large block of size {size}, splitting on lines and sentences")
+        return _split_oversize(blocks[0][1], max_chunk_size)
     
-    logger.info(f"Split content into {len(chunks)} chunks")
-    for i, chunk in enumerate(chunks):
-        logger.info(f"Chunk {i} size: {len(chunk)} characters")
+    # The first block may be the heading that opened this section, so it is not a split point
+    levels = [block[0] for block in blocks[1:] if block[0]]
+    if not levels:
+        return [segment for block in blocks for segment in _split_blocks([block], max_chunk_size)]
     
-    return chunks
+    top = min(levels)
+    sections = []
+    start = 0
+    for i in range(1, len(blocks)):
+        if blocks[i][0] == top:
+            sections.append(blocks[start:i])
+            start = i
+    sections.append(blocks[start:])
+    return [segment for section in sections for segment in _split_blocks(section, max_chunk_size)]
 
-def clean_content_with_claude(content: str, client) -> Optional[str]:
+def split_content(content: str, max_chunk_size: int = 6000, min_chunk_size: int = 1000) -> list:
     """
-    Use Claude Haiku to clean the markdown content, handling large files by splitting into chunks
+    Split content into chunks that respect markdown structure. The markdown is split
+    at headings, then blocks, until every segment fits; adjacent segments are then
+    merged back together up to max_chunk_size. Merged chunks end at content-defined
+    boundaries (see _is_chunk_boundary) once they reach min_chunk_size, so unchanged
+    sections produce identical chunks and hit the response cache.
     """
-    try:
-        # Reduce max chunk size to ensure we stay well within Claude's context window
-        chunks = split_content(content, max_chunk_size=6000)
-        cleaned_chunks = []
-        
-        # Process first chunk (containing frontmatter) differently
-        first_chunk = chunks[0]
-        logger.info(f"Processing first chunk ({len(first_chunk)} characters)")
-        
-        prompt = f"""Please clean up this markdown content by:
+    blocks = _markdown_blocks(content)
+    
+    # Checked once so the per-chunk messages below aren't formatted unless they will be shown
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug(f"Original content size: {len(content)} characters")
+        logger.debug(f"Parsed {len(blocks)} top-level markdown blocks")
+    
+    segments = _split_blocks(blocks, max_chunk_size) if blocks else []
+    # Measure each segment once; chunks are built by slicing segments[start:i]
+    sizes = [len(segment) for segment in segments]
+    chunks = []
+    start = 0
+    current_size = 0
+    
+    for i, size in enumerate(sizes):
+        if current_size + size > max_chunk_size and i > start:
+            chunks.append('\n\n'.join(segments[start:i]))
+            if debug:
+                logger.debug(f"Creating chunk {len(chunks) - 1}: {len(chunks[-1])} characters")
+            start = i
+            current_size = 0
+        # Count the '\n\n' separator along with the segment
+        current_size += size + 2
+        if current_size >= min_chunk_size and _is_chunk_boundary(segments[i]):
+            chunks.append('\n\n'.join(segments[start:i + 1]))
+            if debug:
+                logger.debug(f"Creating chunk {len(chunks) - 1} at content boundary: {len(chunks[-1])} characters")
+            start = i + 1
+            current_size = 0
+    
+    if start < len(segments):
+        chunks.append('\n\n'.join(segments[start:]))
+        if debug:
+            logger.debug(f"Creating final chunk {len(chunks) - 1}: {len(chunks[-1])} characters")
+    
+    logger.info(f"Split content into {len(chunks)} chunks")
+    if debug:
+        for i, chunk in enumerate(chunks):
+            logger.debug(f"Chunk {i} size: {len(chunk)} characters")
+    
+    return chunks
+
+# Cleaning instructions are sent as the system prompt; the user message wraps
+# the content in CONTENT_PROMPT
+FIRST_CHUNK_PROMPT = """Please clean up the markdown content you are given by:
 1. Preserving any YAML frontmatter/metadata block at the start of the file EXACTLY as is, with no changes
 2. Removing any remaining HTML tags in the main content
 3. Fixing any formatting issues in the main content
@@ -109,67 +213,228 @@ IMPORTANT: If the file starts with a YAML block (enclosed in --- or +++ markers)
 completely unchanged, preserving all whitespace, indentation, and values exactly as they appear 
 in the original.
 
-Here's the content to clean:
+Please respond with only the cleaned markdown content, no explanations or other text."""
 
-{first_chunk}
+CHUNK_PROMPT = """Please clean up the markdown content you are given by:
+1. Removing any HTML tags
+2. Fixing any formatting issues
+3. Ensuring proper markdown syntax
+4. Maintaining the original text and structure
 
 Please respond with only the cleaned markdown content, no explanations or other text."""
 
-        # Process first chunk
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 4096,
-            "temperature": 0.0,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt}]
-                }
-            ]
-        })
-
-        response = client.invoke_model(
-            modelId="us.anthropic.claude-3-5-haiku-20241022-v1:0",
-            body=body
-        )
-        
-        response_body = json.loads(response['body'].read())
-        cleaned_chunks.append(response_body['content'][0]['text'])
-
-        # Process remaining chunks with a simpler prompt
-        for i, chunk in enumerate(chunks[1:], 1):
-            logger.info(f"Processing chunk {i} ({len(chunk)} characters)")
-            prompt = f"""Please clean up this markdown content by:
+BATCH_PROMPT = """Please clean up each of the markdown documents you are given independently by:
 1. Removing any HTML tags
 2. Fixing any formatting issues
 3. Ensuring proper markdown syntax
 4. Maintaining the original text and structure
 
-Here's the content to clean:
+Each document is wrapped in <doc id=N>...</doc> tags. Respond with every cleaned document
+wrapped in the same tags with the same id, in the same order, and nothing else."""
 
-{chunk}
+# Framing for the content in the user message
+CONTENT_PROMPT = """Here's the content to clean:
 
-Please respond with only the cleaned markdown content, no explanations or other text."""
+{content}
 
-            body = json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 4096,
-                "temperature": 0.0,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [{"type": "text", "text": prompt}]
-                    }
-                ]
-            })
-
-            response = client.invoke_model(
-                modelId="us.anthropic.claude-3-5-haiku-20241022-v1:0",
-                body=body
-            )
-            
-            response_body = json.loads(response['body'].read())
-            cleaned_chunks.append(response_body['content'][0]['text'])
+Respond only as instructed above, with no explanations or other text."""
+
+# Small chunks are packed into a single request up to this many characters
+BATCH_CHAR_BUDGET = 6000
+BATCH_MAX_DOCS = 8
+BATCH_DOC_RE = re.compile(r'<doc id="?(\d+)"?>\n?(.*?)\n?</doc>', re.DOTALL)
+
+# Prompt variants
+PROMPTS = {
+    'first': FIRST_CHUNK_PROMPT,
+    'chunk': CHUNK_PROMPT,
+}
+
+# Instructions whose cached results can serve each variant: later chunks may
+# have been cleaned on their own or as part of a batch
+CACHE_LOOKUP = {
+    'first': (FIRST_CHUNK_PROMPT,),
+    'chunk': (CHUNK_PROMPT, BATCH_PROMPT),
+}
+
+MODEL_ID = "us.anthropic.claude-3-5-haiku-20241022-v1:0"
+
+MAX_THROTTLE_RETRIES = 5
+
+# Cleaned chunks are cached on disk by content hash so re-runs skip Bedrock
+CACHE_DIR = Path.home() / '.cache' / 'claude_clean'
+
+async def _invoke(client, instructions: str, content: str) -> str:
+    """Send content to Claude with the given instructions, backing off exponentially when throttled"""
+    body = orjson.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 4096,
+        "temperature": 0.0,
+        "system": instructions,
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": CONTENT_PROMPT.format(content=content)}]
+            }
+        ]
+    })
+
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        try:
+            return await _stream_text(client, body)
+        except ClientError as e:
+            # Throttling surfaces as ThrottlingException on the call and as a
+            # throttlingException event if it happens mid-stream
+            if e.response['Error']['Code'].lower() != 'throttlingexception' or attempt == MAX_THROTTLE_RETRIES:
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logger.warning(f"Throttled by Bedrock, retrying in {delay:.2f} seconds...")
+            await asyncio.sleep(delay)
+
+async def _stream_text(client, body: bytes) -> str:
+    """Invoke Claude with a streamed response, collecting the text as it arrives"""
+    response = await client.invoke_model_with_response_stream(modelId=MODEL_ID, body=body)
+    
+    fragments = []
+    async for event in response['body']:
+        if 'chunk' not in event:
+            continue
+        data = orjson.loads(event['chunk']['bytes'])
+        if data['type'] == 'content_block_delta' and data['delta']['type'] == 'text_delta':
+            fragments.append(data['delta']['text'])
+    return ''.join(fragments)
+
+async def _batch_invoke(client, chunks: list) -> Optional[list]:
+    """
+    Clean several chunks in a single request, using <doc> tags to keep them apart.
+    Returns None if the response can't be split back into the same documents.
+    """
+    docs = '\n\n'.join(f'<doc id={i}>\n{chunk}\n</doc>' for i, chunk in enumerate(chunks))
+    response = await _invoke(client, BATCH_PROMPT, docs)
+    
+    cleaned = {int(doc_id): text for doc_id, text in BATCH_DOC_RE.findall(response)}
+    if sorted(cleaned) != list(range(len(chunks))):
+        return None
+    return [cleaned[i] for i in range(len(chunks))]
+
+def _pack_batches(indices: list, chunks: list) -> list:
+    """Greedily group chunk indices into batches that fit the batch budget"""
+    batches = []
+    current = []
+    current_size = 0
+    for i in indices:
+        if current and (current_size + len(chunks[i]) > BATCH_CHAR_BUDGET or len(current) == BATCH_MAX_DOCS):
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(i)
+        current_size += len(chunks[i])
+    if current:
+        batches.append(current)
+    return batches
+
+async def _clean_batch(client, chunks: list, variant: str, semaphore: asyncio.Semaphore) -> tuple:
+    """
+    Clean a batch of chunks, falling back to one request per chunk if batching fails.
+    Every request holds the file's semaphore while in flight.
+    Returns the instructions that were used along with the cleaned chunks.
+    """
+    if len(chunks) > 1:
+        async with semaphore:
+            cleaned = await _batch_invoke(client, chunks)
+        if cleaned is not None:
+            return BATCH_PROMPT, cleaned
+        logger.warning(f"Could not split batched response, cleaning {len(chunks)} chunks individually")
+    instructions = PROMPTS[variant]
+    
+    async def invoke(chunk: str) -> str:
+        async with semaphore:
+            return await _invoke(client, instructions, chunk)
+    
+    return instructions, await asyncio.gather(*(invoke(chunk) for chunk in chunks))
+
+def _cache_path(cache_dir: Path, instructions: str, chunk: str) -> Path:
+    """
+    Return the cache file for a chunk cleaned with the given instructions. The
+    model and prompt text are part of the key, so changing any of them
+    invalidates old entries.
+    """
+    key = hashlib.sha256(f"{MODEL_ID}\0{instructions}\0{CONTENT_PROMPT}\0{chunk}".encode()).hexdigest()
+    return cache_dir / key[:2] / f"{key}.txt"
+
+async def _read_cache(cache_dir: Optional[Path], variant: str, chunk: str) -> Optional[str]:
+    """Return the cached cleaned chunk, or None on a miss or an unreadable entry"""
+    if cache_dir is None:
+        return None
+    for instructions in CACHE_LOOKUP[variant]:
+        cache_path = _cache_path(cache_dir, instructions, chunk)
+        try:
+            if not await aiofiles.os.path.exists(cache_path):
+                continue
+            async with aiofiles.open(cache_path, 'r', encoding='utf-8') as f:
+                cleaned = await f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {cache_path}: {e}")
+            continue
+        if cleaned:
+            return cleaned
+    return None
+
+async def _write_cache(cache_dir: Optional[Path], instructions: str, chunk: str, cleaned: str):
+    """Store a chunk cleaned with the given instructions in the cache, logging any failure"""
+    # Empty responses are never cached so a bad response isn't reused forever
+    if cache_dir is None or not cleaned:
+        return
+    cache_path = _cache_path(cache_dir, instructions, chunk)
+    # Write to a temporary file and rename so readers never see a partial entry
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+            await f.write(cleaned)
+        await aiofiles.os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not write cache entry {cache_path}: {e}")
+        with contextlib.suppress(OSError):
+            await aiofiles.os.remove(tmp_path)
+
+async def clean_chunks_with_claude(chunks: list, client, cache_dir: Optional[Path] = CACHE_DIR) -> Optional[str]:
+    """
+    Use Claude Haiku to clean markdown content that has already been split by split_content.
+    Chunks already cleaned in a previous run are read from cache_dir (None disables the cache).
+    """
+    try:
+        # The first chunk (containing frontmatter) gets the stricter prompt
+        variants = ['first'] + ['chunk'] * (len(chunks) - 1)
+
+        cleaned_chunks = await asyncio.gather(*(
+            _read_cache(cache_dir, variant, chunk) for variant, chunk in zip(variants, chunks)
+        ))
+        # Blank chunks (e.g. an empty file) have nothing to clean, so they skip Claude
+        for i, chunk in enumerate(chunks):
+            if not chunk.strip():
+                cleaned_chunks[i] = chunk
+        pending = [i for i, cleaned in enumerate(cleaned_chunks) if cleaned is None]
+
+        # The first chunk is always sent on its own; small remaining chunks share requests
+        batches = [[i] for i in pending if variants[i] == 'first']
+        batches += _pack_batches([i for i in pending if variants[i] == 'chunk'], chunks)
+
+        # Batches are independent, so send them all at once, up to the per-file limit
+        semaphore = asyncio.Semaphore(MAX_REQUESTS_PER_FILE)
+        logger.info(f"Processing {len(pending)} of {len(chunks)} chunks in {len(batches)} requests "
+                    f"({len(chunks) - len(pending)} cached)")
+        results = await asyncio.gather(*(
+            _clean_batch(client, [chunks[i] for i in batch], variants[batch[0]], semaphore) for batch in batches
+        ))
+        used_instructions = {}
+        for batch, (instructions, cleaned) in zip(batches, results):
+            for i, text in zip(batch, cleaned):
+                cleaned_chunks[i] = text
+                used_instructions[i] = instructions
+        await asyncio.gather(*(
+            _write_cache(cache_dir, used_instructions[i], chunks[i], cleaned_chunks[i]) for i in pending
+        ))
 
         # Combine cleaned chunks
         result = '\n\n'.join(cleaned_chunks)
@@ -180,56 +445,74 @@ Please respond with only the cleaned markdown content, no explanations or other
         logger.error(f"Error cleaning content with Claude: {e}")
         return None
 
-def process_markdown_file(input_file: str, output_file: Optional[str] = None, skip_existing: bool = False):
+async def clean_content_with_claude(content: str, client, cache_dir: Optional[Path] = CACHE_DIR) -> Optional[str]:
+    """
+    Use Claude Haiku to clean the markdown content, handling large files by splitting into chunks
+    """
+    # Reduce max chunk size to ensure we stay well within Claude's context window
+    chunks = split_content(content, max_chunk_size=6000)
+    return await clean_chunks_with_claude(chunks, client, cache_dir)
+
+def get_output_path(input_path: Path, output_file: Optional[str] = None) -> Path:
     """
-    Process a single markdown file
+    Work out where the cleaned version of a file is written
     Args:
-        input_file: Input file path
+        input_path: Input file path
         output_file: Output file path (optional)
-        skip_existing: Skip processing if output file already exists
     """
-    client = get_bedrock_client()
-    input_path = Path(input_file)
+    if output_file is not None:
+        return Path(output_file)
     
     # If no output file specified, create one in output_clean directory
-    if output_file is None:
-        # Get the relative path from the input directory to the file
-        if 'downloaded_sites' in str(input_path.parent):
-            # Replace 'downloaded_sites' with 'output_clean' in the path
-            output_path = Path(str(input_path).replace('downloaded_sites', 'output_clean'))
-        elif 'output' in str(input_path.parent):
-            # Replace the first occurrence of 'output' with 'output_clean'
-            parts = input_path.parts
-            output_index = parts.index('output')
-            new_parts = parts[:output_index] + ('output_clean',) + parts[output_index + 1:]
-            output_path = Path(*new_parts)
-        else:
-            # Create output path in 'output_clean' directory parallel to input file
-            output_path = input_path.parent.parent / 'output_clean' / input_path.name
+    # Get the relative path from the input directory to the file
+    if 'downloaded_sites' in str(input_path.parent):
+        # Replace 'downloaded_sites' with 'output_clean' in the path
+        return Path(str(input_path).replace('downloaded_sites', 'output_clean'))
+    elif 'output' in str(input_path.parent):
+        # Replace the first occurrence of 'output' with 'output_clean'
+        parts = input_path.parts
+        output_index = parts.index('output')
+        new_parts = parts[:output_index] + ('output_clean',) + parts[output_index + 1:]
+        return Path(*new_parts)
     else:
-        output_path = Path(output_file)
-    
-    # Skip if file exists and skip-existing is enabled
-    if skip_existing and os.path.exists(output_path):
-        print(f"Skipping existing file: {output_path}")
-        return
-    
-    # Create output directory if it doesn't exist
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+        # Create output path in 'output_clean' directory parallel to input file
+        return input_path.parent.parent / 'output_clean' / input_path.name
+
+async def split_markdown_file(input_path: Path, pool: ProcessPoolExecutor) -> list:
+    """
+    Read a markdown file and split it into chunks, doing the CPU-bound
+    splitting in the process pool so it doesn't hold up the event loop
+    """
+    async with aiofiles.open(input_path, 'r', encoding='utf-8') as f:
+        content = await f.read()
     
+    loop = asyncio.get_running_loop()
+    # Reduce max chunk size to ensure we stay well within Claude's context window
+    return await loop.run_in_executor(pool, partial(split_content, content, max_chunk_size=6000))
+
+async def process_markdown_file(input_path: Path, output_path: Path, chunks: list, client,
+                                cache_dir: Optional[Path] = CACHE_DIR):
+    """
+    Clean a single markdown file that has already been split into chunks
+    Args:
+        input_path: Input file path
+        output_path: Output file path
+        chunks: Chunks of the input file from split_content
+        client: Shared async Bedrock client
+        cache_dir: Directory of cached chunk responses (None disables the cache)
+    """
     try:
-        # Read content
-        with open(input_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
         # Clean content
         logger.info(f"Processing: {input_path}")
-        cleaned_content = clean_content_with_claude(content, client)
+        cleaned_content = await clean_chunks_with_claude(chunks, client, cache_dir)
         
-        if cleaned_content:
+        if cleaned_content is not None:
+            # Create output directory if it doesn't exist
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            
             # Save cleaned content
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(cleaned_content)
+            async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
+                await f.write(cleaned_content)
             logger.info(f"Saved cleaned file: {output_path}")
         else:
             logger.error(f"Failed to clean: {input_path}")
@@ -237,6 +520,52 @@ def process_markdown_file(input_file: str, output_file: Optional[str] = None, sk
     except Exception as e:
         logger.error(f"Error processing {input_path}: {e}")
 
+async def process_files(files_to_process: list, output_file: Optional[str], skip_existing: bool, workers: int,
+                        cache_dir: Optional[Path] = CACHE_DIR):
+    """
+    Clean all files in two stages: files are read and split into chunks in a process
+    pool, then `workers` consumers clean them on the event loop with one shared Bedrock
+    client. A bounded queue between the stages keeps memory flat.
+    """
+    queue = asyncio.Queue(maxsize=workers * 2)
+    pending_files = iter(files_to_process)
+    split_workers = os.cpu_count() or 1
+    
+    async def produce(pool: ProcessPoolExecutor):
+        # Producers share one iterator, so each file is split exactly once
+        for file_path in pending_files:
+            input_path = Path(file_path)
+            try:
+                output_path = get_output_path(input_path, output_file)
+                
+                # Skip if file exists and skip-existing is enabled
+                if skip_existing and os.path.exists(output_path):
+                    print(f"Skipping existing file: {output_path}")
+                    continue
+                
+                chunks = await split_markdown_file(input_path, pool)
+            except Exception as e:
+                logger.error(f"Error processing {input_path}: {e}")
+                continue
+            await queue.put((input_path, output_path, chunks))
+    
+    async def consume(client):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            await process_markdown_file(*job, client, cache_dir)
+    
+    session = aioboto3.Session()
+    with ProcessPoolExecutor(max_workers=split_workers) as pool:
+        pool_size = max(MIN_POOL_CONNECTIONS, workers * MAX_REQUESTS_PER_FILE)
+        async with get_bedrock_client(session, pool_size) as client:
+            consumers = [asyncio.create_task(consume(client)) for _ in range(workers)]
+            await asyncio.gather(*(produce(pool) for _ in range(split_workers)))
+            for _ in consumers:
+                await queue.put(None)
+            await asyncio.gather(*consumers)
+
 def main():
     parser = argparse.ArgumentParser(description='Clean markdown files using Claude Haiku')
     parser.add_argument('--input', required=True, help='Input markdown file or directory path')
@@ -244,7 +573,11 @@ def main():
     parser.add_argument('--skip-existing', action='store_true', 
                        help='Skip processing if output file already exists')
     parser.add_argument('--workers', type=int, default=4,
-                       help='Number of parallel workers (default: 4)')
+                       help='Number of files to clean concurrently (default: 4)')
+    parser.add_argument('--cache-dir', default=str(CACHE_DIR),
+                       help=f'Directory for cached Claude responses (default: {CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Always call Claude instead of reusing cached responses')
     
     args = parser.parse_args()
     
@@ -257,25 +590,8 @@ def main():
     
     logger.info(f"Found {len(files_to_process)} files to process")
     
-    # Process files in parallel using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        # Create a list of futures
-        futures = [
-            executor.submit(
-                process_markdown_file,
-                str(file_path),
-                args.output,
-                args.skip_existing
-            )
-            for file_path in files_to_process
-        ]
-        
-        # Wait for all futures to complete
-        for future in futures:
-            try:
-                future.result()  # This will raise any exceptions that occurred
-            except Exception as e:
-                logger.error(f"Error processing file: {e}")
+    cache_dir = None if args.no_cache else Path(args.cache_dir).expanduser()
+    asyncio.run(process_files(files_to_process, args.output, args.skip_existing, args.workers, cache_dir))
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
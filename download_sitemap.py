@@ -1,13 +1,18 @@
 import argparse
 import os
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 from urllib.parse import urlparse
 import logging
-import json
+import orjson
 from typing import Optional
+from pathlib import Path
 import time
-import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,31 +20,112 @@ logger = logging.getLogger(__name__)
 # This should be set as an environment variable or passed as an argument
 RAPID_API_KEY = os.getenv('RAPID_API_KEY')
 
-def parse_sitemap(sitemap_url):
+# Shared session so TCP+TLS connections are kept alive and reused across URLs.
+# 429s are not retried here; get_with_backoff handles them using Retry-After.
+# raise_on_status=False hands back the last response once retries run out, so
+# like a plain requests.get a bad status never raises and callers check it.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                      raise_on_status=False)
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+MAX_RATE_LIMIT_RETRIES = 8
+MAX_BACKOFF = 60
+
+def get_with_backoff(url: str, **kwargs) -> requests.Response:
+    """
+    GET a URL, only waiting when the API responds with 429 Too Many Requests.
+    Waits for the Retry-After header (default 2 seconds) or the exponential
+    backoff, whichever is longer, capped at MAX_BACKOFF seconds.
+    """
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        response = SESSION.get(url, **kwargs)
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            return response
+        
+        try:
+            retry_after = int(response.headers.get('Retry-After', 2))
+        except ValueError:
+            # Retry-After can also be an HTTP date; fall back to plain backoff
+            retry_after = 0
+        delay = min(max(retry_after, 2 ** attempt), MAX_BACKOFF)
+        logger.warning(f"Rate limited by {urlparse(url).netloc}, retrying in {delay} seconds...")
+        time.sleep(delay)
+
+class RateLimiter:
+    """
+    Token bucket limiting how many requests are started per second across threads.
+    A rate of 0 or less disables limiting.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a request may be started"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Sitemap tags and the <loc> lookup, built once at import. Matching on the
+# local name accepts any namespace (sitemaps.org 0.9, Google's older 0.84,
+# or none at all), like the baseline did by reading it from the root element.
+_ENTRY_TAGS = ('{*}url', '{*}sitemap')
+_LOC_XPATH = etree.XPath("string(*[local-name()='loc'])")
+
+def parse_sitemap(sitemap_url, seen: Optional[set] = None):
     """
-    Parse the sitemap XML and return a list of URLs
+    Stream the sitemap XML and yield its URLs as they are parsed, so downloads
+    can start before the whole sitemap has been read. Sitemap indexes are
+    followed into each of the sitemaps they list; `seen` tracks sitemaps
+    already fetched so cycles and duplicate entries are only read once.
     """
+    if seen is None:
+        seen = set()
+    seen.add(sitemap_url)
+    
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         }
-        response = requests.get(sitemap_url, headers=headers)
-        response.raise_for_status()
-        
-        root = ET.fromstring(response.content)
-        # Remove namespace for easier parsing
-        namespace = root.tag.split('}')[0] + '}'
-        
-        urls = []
-        for url in root.findall(f'.//{namespace}url'):
-            loc = url.find(f'{namespace}loc')
-            if loc is not None:
-                urls.append(loc.text)
-        
-        return urls
+        with SESSION.get(sitemap_url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            # Let urllib3 undo any gzip/deflate transfer encoding
+            response.raw.decode_content = True
+            
+            for _, elem in etree.iterparse(response.raw, events=('end',), tag=_ENTRY_TAGS):
+                loc = _LOC_XPATH(elem).strip()
+                if loc and etree.QName(elem).localname == 'url':
+                    yield loc
+                elif loc in seen:
+                    logger.info(f"Skipping already parsed sitemap: {loc}")
+                elif loc:
+                    logger.info(f"Following nested sitemap: {loc}")
+                    yield from parse_sitemap(loc, seen)
+                
+                # Drop parsed entries so memory stays flat on large sitemaps
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
     except Exception as e:
         logger.error(f"Error parsing sitemap: {e}")
-        return []
 
 def parse_article(article_url):
     """
@@ -57,7 +143,12 @@ def parse_article(article_url):
         "x-rapidapi-key": RAPID_API_KEY,
         "x-rapidapi-host": "article-extractor2.p.rapidapi.com"
     }
-    response = requests.get(url, headers=headers, params=querystring)
+    response = get_with_backoff(url, headers=headers, params=querystring)
+    if not response.ok:
+        # Gateway errors (e.g. rate limits) aren't article responses; report them
+        # in the API's own error shape so they are neither converted nor saved
+        logger.error(f"Article extraction request failed with HTTP {response.status_code} for {article_url}")
+        return {"error": response.status_code, "message": response.text}
     return response.json()
 
 def download_with_semareader(article_url: str) -> dict:
@@ -80,7 +171,7 @@ def download_with_semareader(article_url: str) -> dict:
     }
     
     try:
-        response = requests.get(url, headers=headers, params=querystring)
+        response = get_with_backoff(url, headers=headers, params=querystring)
         response.raise_for_status()
         return response.json()
     except Exception as e:
@@ -137,26 +228,25 @@ def convert_to_markdown(article_data: dict, url: str) -> Optional[str]:
         logger.error(f"Error converting to markdown: {e}")
         return None
 
-def save_markdown(content, url, output_dir):
+# Directories already created by this run, so each one is only made once
+_MKDIR_CACHE = set()
+
+def ensure_parent_dir(file_path: str) -> None:
+    """
+    Create the directory containing file_path unless this run already has
+    """
+    directory = os.path.dirname(file_path)
+    if directory not in _MKDIR_CACHE:
+        os.makedirs(directory, exist_ok=True)
+        _MKDIR_CACHE.add(directory)
+
+def save_markdown(content: str, file_path: str):
     """
     Save markdown content to a file
     """
     try:
-        # Parse the URL to create directory structure
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc
-        path = parsed_url.path.strip('/')
-        
-        if not path:
-            path = 'index'
-        
         # Create directory structure
-        file_path = os.path.join(output_dir, domain, path)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # Add .md extension if not present
-        if not file_path.endswith('.md'):
-            file_path += '.md'
+        ensure_parent_dir(file_path)
         
         # Save the content
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -164,24 +254,15 @@ def save_markdown(content, url, output_dir):
             
         logger.info(f"Saved: {file_path}")
     except Exception as e:
-        logger.error(f"Error saving file for {url}: {e}")
+        logger.error(f"Error saving file {file_path}: {e}")
 
-def save_json_response(article_data: dict, url: str, output_dir: str, parser: str):
+def save_json_response(article_data: dict, url: str, file_path: str, parser: str):
     """
     Save the raw JSON response along with metadata about the parser used
     """
     try:
-        # Parse the URL to create directory structure
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc
-        path = parsed_url.path.strip('/') or 'index'
-        
         # Create directory structure
-        file_path = os.path.join(output_dir, domain, path)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # Add .json extension
-        file_path += '.json'
+        ensure_parent_dir(file_path)
         
         # Add metadata about the parser used
         response_data = {
@@ -192,13 +273,25 @@ def save_json_response(article_data: dict, url: str, output_dir: str, parser: st
         }
         
         # Save the content
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(response_data, f, indent=2, ensure_ascii=False)
+        with open(file_path, 'wb') as f:
+            f.write(orjson.dumps(response_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
             
         logger.info(f"Saved JSON: {file_path}")
     except Exception as e:
         logger.error(f"Error saving JSON file for {url}: {e}")
 
+@lru_cache(maxsize=4096)
+def _get_base_path(url: str, output_dir: str) -> str:
+    """
+    Generate the output path for a URL without an extension. Cached so the
+    markdown and JSON paths for a URL only parse it once.
+    """
+    parsed_url = urlparse(url)
+    domain = parsed_url.netloc
+    path = parsed_url.path.strip('/') or 'index'
+    
+    return os.path.join(output_dir, domain, path)
+
 def get_markdown_path(url: str, output_dir: str) -> str:
     """
     Generate the markdown file path for a given URL
@@ -210,25 +303,75 @@ def get_markdown_path(url: str, output_dir: str) -> str:
     Returns:
         str: Full path where markdown file should be saved
     """
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
-    path = parsed_url.path.strip('/') or 'index'
-    
-    # Create file path
-    file_path = os.path.join(output_dir, domain, path)
+    file_path = _get_base_path(url, output_dir)
     if not file_path.endswith('.md'):
         file_path += '.md'
         
     return file_path
 
+def get_json_path(url: str, output_dir: str) -> str:
+    """
+    Generate the path of the raw JSON response saved for a given URL
+    
+    Args:
+        url: The URL to generate path for
+        output_dir: Base output directory
+        
+    Returns:
+        str: Full path where the JSON response is saved
+    """
+    return _get_base_path(url, output_dir) + '.json'
+
+def is_successful_response(article_data, parser: str) -> bool:
+    """
+    Check that an API response is a successful extraction for the given parser
+    """
+    if not isinstance(article_data, dict):
+        return False
+    if parser == 'semareader':
+        return article_data.get('success') is True
+    return article_data.get('error') == 0 and isinstance(article_data.get('data'), dict)
+
+def load_cached_response(json_path: str, parser: str) -> Optional[dict]:
+    """
+    Load the API response saved by a previous run with the same parser
+    
+    Args:
+        json_path: Path written by save_json_response
+        parser: Parser the response must have come from
+        
+    Returns:
+        Optional[dict]: The cached article data, or None if there is no usable response
+    """
+    try:
+        if os.path.getsize(json_path) == 0:
+            return None
+        with open(json_path, 'rb') as f:
+            json_data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cached response {json_path}: {e}")
+        return None
+    
+    if not isinstance(json_data, dict) or json_data.get('parser') != parser:
+        return None
+    
+    # Don't reuse failed extractions so they are retried
+    article_data = json_data.get('response')
+    if not is_successful_response(article_data, parser):
+        return None
+    
+    return article_data
+
 def update_markdown_with_metadata(markdown_path: str, json_path: str) -> None:
     """
     Update an existing markdown file with metadata from its companion JSON file
     """
     try:
         # Read the JSON data
-        with open(json_path, 'r', encoding='utf-8') as f:
-            json_data = json.load(f)
+        with open(json_path, 'rb') as f:
+            json_data = orjson.loads(f.read())
             
         # Get the article data and URL
         article_data = json_data['response']
@@ -294,18 +437,70 @@ def update_existing_files(output_dir: str) -> None:
                 else:
                     logger.warning(f"No companion JSON file found for: {md_path}")
 
+def process_url(url: str, args: argparse.Namespace, rate_limiter: RateLimiter) -> None:
+    """
+    Download a single URL and save it as JSON and markdown
+    
+    Args:
+        url: The URL to download
+        args: Parsed command line arguments
+        rate_limiter: Shared limiter for API requests
+    """
+    if args.dry_run:
+        file_path = get_markdown_path(url, args.output_dir)
+        logger.info(f"Would download: {url}")
+        logger.info(f"Would save to: {file_path}")
+        return
+    
+    logger.info(f"Processing: {url}")
+    file_path = get_markdown_path(url, args.output_dir)
+    
+    # Reuse the JSON response saved by a previous run instead of paying for the API call
+    json_path = get_json_path(url, args.output_dir)
+    article_data = None
+    if not args.refresh_api:
+        article_data = load_cached_response(json_path, args.parser)
+        if article_data is not None:
+            logger.info(f"Using cached API response for: {url}")
+    
+    if article_data is None:
+        rate_limiter.acquire()
+        
+        # Choose parser based on argument
+        if args.parser == 'semareader':
+            article_data = download_with_semareader(url)
+        else:
+            article_data = parse_article(url)
+            
+        # Save the raw JSON response first; failures aren't saved so the next run retries them
+        if is_successful_response(article_data, args.parser):
+            save_json_response(article_data, url, json_path, args.parser)
+        
+    content = convert_to_markdown(article_data, url)
+    if content:
+        save_markdown(content, file_path)
+
 def main():
     parser = argparse.ArgumentParser(description='Download sitemap pages as markdown')
     parser.add_argument('--sitemap_url', required=True, help='URL of the sitemap.xml file')
     parser.add_argument('--output_dir', default='output', help='Output directory for markdown files')
     parser.add_argument('--api_key', help='RapidAPI key (can also be set as RAPID_API_KEY env variable)')
     parser.add_argument('--dry-run', action='store_true', help='Show what would be downloaded without actually downloading')
-    parser.add_argument('--no-random-sleep', action='store_true', help='Disable random sleep between requests')
+    parser.add_argument('--no-rate-limit', '--no-random-sleep', action='store_true',
+                       help='Disable request rate limiting (same as --rps 0)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                       help='Number of URLs to download in parallel (default: 8)')
+    parser.add_argument('--rps', type=float, default=0,
+                       help='Maximum API requests started per second (default: 0, no limit; '
+                            'requests still back off when the API responds with 429)')
     parser.add_argument('--parser', choices=['article-extractor2', 'semareader'], 
                        default='article-extractor2',
                        help='Choose which parser to use')
     parser.add_argument('--force', action='store_true', 
-                       help='Override existing files instead of skipping them')
+                       help='Override existing files instead of skipping them '
+                            '(saved API responses are still reused; add --refresh-api to call the API again)')
+    parser.add_argument('--refresh-api', action='store_true',
+                       help='Call the API even when a saved JSON response exists')
     parser.add_argument('--limit', type=int, 
                        help='Limit the number of articles to download')
     parser.add_argument('--filter', type=str,
@@ -333,55 +528,37 @@ def main():
     if not args.dry_run:
         os.makedirs(args.output_dir, exist_ok=True)
     
-    # Get URLs from sitemap
-    urls = parse_sitemap(args.sitemap_url)
-    logger.info(f"Found {len(urls)} URLs in sitemap")
+    # Get URLs from sitemap, dropping duplicates but keeping sitemap order
+    urls = list(dict.fromkeys(parse_sitemap(args.sitemap_url)))
+    logger.info(f"Found {len(urls)} unique URLs in sitemap")
     
     # Filter URLs if filter argument is provided
     if args.filter:
         urls = [url for url in urls if args.filter in url]
         logger.info(f"After filtering for '{args.filter}': {len(urls)} URLs remain")
     
-    # Process each URL
-    attempts = 0  # Track total attempts instead of successful downloads
-    for url in urls:
-        if args.limit and attempts >= args.limit:
-            logger.info(f"Reached limit of {args.limit} attempts, stopping.")
-            break
-            
-        attempts += 1  # Increment attempts counter before processing
-            
-        if args.dry_run:
-            file_path = get_markdown_path(url, args.output_dir)
-            logger.info(f"Would download: {url}")
-            logger.info(f"Would save to: {file_path}")
-        else:
-            logger.info(f"Processing: {url}")
-            
-            # Check if file already exists
-            file_path = get_markdown_path(url, args.output_dir)
-            if os.path.exists(file_path) and not args.force:
-                logger.info(f"File already exists, skipping: {file_path}")
-                continue
-                
-            # Add random sleep unless --no-random-sleep is specified
-            if not args.no_random_sleep:
-                sleep_time = random.uniform(1, 12)
-                logger.info(f"Sleeping for {sleep_time:.2f} seconds...")
-                time.sleep(sleep_time)
-            
-            # Choose parser based on argument
-            if args.parser == 'semareader':
-                article_data = download_with_semareader(url)
-            else:
-                article_data = parse_article(url)
-                
-            # Save the raw JSON response first
-            save_json_response(article_data, url, args.output_dir, args.parser)
-                
-            content = convert_to_markdown(article_data, url)
-            if content:
-                save_markdown(content, url, args.output_dir)
+    # Drop pages that were already downloaded, scanning the output directory
+    # once instead of stat-ing every URL's file
+    if not args.force:
+        existing = set(Path(args.output_dir).rglob('*.md'))
+        pending = [url for url in urls if Path(get_markdown_path(url, args.output_dir)) not in existing]
+        logger.info(f"Skipping {len(urls) - len(pending)} already downloaded, {len(pending)} URLs to download")
+        urls = pending
+    
+    if args.limit and len(urls) > args.limit:
+        logger.info(f"Limiting to the first {args.limit} URLs")
+        urls = urls[:args.limit]
+    
+    # Process URLs concurrently; the rate limiter keeps us within the provider's limits
+    rate_limiter = RateLimiter(0 if args.no_rate_limit else args.rps)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(process_url, url, args, rate_limiter) for url in urls]
+        
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error processing URL: {e}")
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file